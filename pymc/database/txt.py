@@ -1,15 +1,26 @@
 """
 TXT database module
 
-Store the traces in ASCII files.
+Store the traces in flat files.
 
 For each chain, a directory named `Chain_#` is created. In this directory,
 one file per tallyable object is created containing the values of the object.
 
 Implementation Notes
 --------------------
-The NumPy arrays are saved and loaded using NumPy's `loadtxt` and `savetxt`
-functions.
+By default, the NumPy arrays are saved in NumPy's binary `.npy` format using
+`save` and read back with `load`, optionally memory-mapped. A small `.meta`
+text file holding the human-readable header is written alongside each `.npy`
+file. Traces of Python objects are always saved in ASCII. Setting
+`binary=False` restores the ASCII format, in which case the arrays are saved
+using NumPy's `savetxt` function and loaded using pandas' C parser
+`read_csv`, or NumPy's `loadtxt` if pandas is not installed. Directories
+written in the ASCII format can always be loaded.
+
+With `compact=True`, runs of identical consecutive samples (e.g. rejected
+MCMC proposals) are stored once along with their length. Binary traces are
+then saved in a `.npz` archive holding the `values` and `counts` arrays,
+and ASCII traces get a leading column holding the run lengths.
 
 Changeset
 ---------
@@ -20,54 +31,110 @@ Oct. 1, 2009: Added support for multidimensional arrays.
 
 
 import base, ram
-import os, datetime, shutil, re
+import os, sys, datetime, shutil, re, ast
 import numpy as np
 from numpy import array
 import string
+from cStringIO import StringIO
+from collections import defaultdict
 
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
 
 __all__ = ['Trace', 'Database', 'load']
 
 CHAIN_NAME = 'Chain_%d'
 
+# Header line flagging ASCII traces whose first column holds run lengths.
+RUNS_HEADER = '# Run lengths: first column'
+
+# ASCII traces smaller than this (in bytes) bypass read_csv and loadtxt.
+SMALL_TXT_SIZE = 1<<20
+
+# Matches the sample shape in the header of an ASCII trace file.
+_SHAPE_RE = re.compile(r'# Sample shape:\s*\(([^)]*)\)')
+
 class Trace(ram.Trace):
     """Txt Trace Class.
 
-    Store the trace in a ASCII file located in one directory per chain.
+    Store the trace in a binary (or ASCII) file located in one directory per
+    chain.
 
     dbname/
       Chain_0/
-        <object name>.txt
-        <object name>.txt
+        <object name>.npy
+        <object name>.meta
         ...
       Chain_1/
-        <object name>.txt
-        <object name>.txt
+        <object name>.npy
+        <object name>.meta
         ...
       ...
+
+    With `binary=False`, a single <object name>.txt file is written instead
+    of the .npy/.meta pair. With `compact=True`, the .npy file is replaced
+    by a .npz archive.
     """
 
     def _finalize(self, chain):
-        """Write the trace to an ASCII file.
+        """Write the trace to a binary .npy file, or an ASCII file if the
+        database was created with `binary=False`.
 
         :Parameter:
         chain : int
           The chain index.
         """
-        path = os.path.join(self.db._directory, self.db.get_chains()[chain], self.name+'.txt')
+        folder = os.path.join(self.db._directory, self.db.get_chains()[chain])
         arr = self.gettrace(chain=chain)
-        
-        with open(path, 'w') as f:
-            print >> f, '# Variable: %s' % self.name
-            print >> f, '# Sample shape: %s' % str(arr.shape)
-            print >> f, '# Date: %s' % datetime.datetime.now()
-            np.savetxt(f, arr.reshape((-1, arr[0].size)), delimiter=',')
-            f.close()
+        shape = arr.shape
+        compact = self.db.compact
+        if compact:
+            arr, counts = _runs(arr)
+
+        # np.save pickles object arrays, which cannot be memory-mapped.
+        if self.db.binary and not arr.dtype.hasobject:
+            with open(os.path.join(folder, self.name+'.meta'), 'w') as f:
+                self._write_header(f, shape, compact)
+            if compact:
+                np.savez(os.path.join(folder, self.name+'.npz'), values=arr, counts=counts)
+            else:
+                np.save(os.path.join(folder, self.name+'.npy'), arr)
+        else:
+            arr_shape = arr.shape
+            flat_shape = (-1, int(np.prod(shape[1:])))
+            # Flatten the samples in place; only copy if the memory layout
+            # does not allow it.
+            try:
+                arr.shape = flat_shape
+                flat = arr
+            except AttributeError:
+                flat = np.ascontiguousarray(arr).reshape(flat_shape)
+            if compact:
+                flat = np.column_stack((counts, flat))
+
+            with open(os.path.join(folder, self.name+'.txt'), 'w', 1<<20) as f:
+                self._write_header(f, shape, compact)
+                # 17 significant digits are enough to round-trip doubles.
+                np.savetxt(f, flat, fmt='%.17g', delimiter=',')
+            arr.shape = arr_shape
+
+    def _write_header(self, f, shape, compact=False):
+        """Write the variable name, sample shape and date to file f."""
+        print >> f, '# Variable: %s' % self.name
+        print >> f, '# Sample shape: %s' % str(shape)
+        if compact:
+            print >> f, RUNS_HEADER
+        print >> f, '# Date: %s' % datetime.datetime.now()
 
 class Database(base.Database):
     """Txt Database class."""
 
-    def __init__(self, dbname=None, dbmode='a'):
+    def __init__(self, dbname=None, dbmode='a', binary=True, compact=False):
         """Create a Txt Database.
 
         :Parameters:
@@ -75,11 +142,19 @@ class Database(base.Database):
           Name of the directory where the traces are stored.
         dbmode : {a, r, w}
           Opening mode: a:append, w:write, r:read.
+        binary : bool
+          If True, store the traces in binary .npy files with a .meta
+          header file. If False, store them in ASCII .txt files.
+        compact : bool
+          If True, store runs of identical consecutive samples only once,
+          along with their length.
         """
         self.__name__ = 'txt'
         self._directory = dbname
         self.__Trace__ = Trace
         self.mode = dbmode
+        self.binary = binary
+        self.compact = compact
 
         self.trace_names = []   # A list of sequences of names of the objects to tally.
         self._traces = {} # A dictionary of the Trace objects.
@@ -97,9 +172,8 @@ class Database(base.Database):
         directory."""
         chains = []
         try:
-            content = os.listdir(self._directory)
-            for c in content:
-                if os.path.isdir(os.path.join(self._directory, c)) and c.startswith(CHAIN_NAME[:-2]):
+            for c in _listdir(self._directory, dirs=True):
+                if c.startswith(CHAIN_NAME[:-2]):
                     chains.append(c)
         except:
             pass
@@ -116,19 +190,29 @@ class Database(base.Database):
 
     def savestate(self, state):
         """Save the sampler's state in a state.txt file."""
-        oldstate = np.get_printoptions()
-        np.set_printoptions(threshold=1e6)
-        try:
-            with open(os.path.join(self._directory, 'state.txt'), 'w') as f:
-                print >> f, state
-                f.close()
-        finally:
-            np.set_printoptions(**oldstate)
+        with open(os.path.join(self._directory, 'state.txt'), 'w') as f:
+            f.write(_staterepr(state))
 
 
 
-def load(dirname):
-    """Create a Database instance from the data stored in the directory."""
+def load(dirname, mmap=False, binary=None, compact=None):
+    """Create a Database instance from the data stored in the directory.
+
+    :Parameters:
+    dirname : string
+      Name of the directory where the traces are stored.
+    mmap : bool
+      If True, memory-map the binary .npy traces in read-only mode instead
+      of reading them in memory. Each memory-mapped trace keeps a file
+      descriptor open while it is in use.
+    binary, compact : bool
+      Format of the chains appended to the database, as in `Database`. By
+      default, the format of the last stored chain is kept.
+
+    Compact .npz traces are expanded back to one row per sample. ASCII .txt
+    traces, written with `binary=False` or by older versions, are parsed
+    with `read_csv` if pandas is available, and `loadtxt` otherwise.
+    """
     if not os.path.exists(dirname):
         raise AttributeError, 'No txt database named %s'%dirname
 
@@ -136,26 +220,42 @@ def load(dirname):
     chain_folders = [os.path.join(dirname, c) for c in db.get_chains()]
     db.chains = len(chain_folders)
 
-    data = {}
+    data = defaultdict(dict)
+    ascii = defaultdict(list)
+    files = []
     for chain, folder in enumerate(chain_folders):
-        files = os.listdir(folder)
+        files = [f for f in _listdir(folder) if os.path.splitext(f)[1] in ('.npy', '.npz', '.txt')]
         funnames = funname(files)
         db.trace_names.append(funnames)
-        for file in files:
-            name = funname(file)
-            if not data.has_key(name):
-                data[name] = {} # This could be simplified using "collections.defaultdict(dict)". New in Python 2.5
-            # Read the shape information
-            with open(os.path.join(folder, file)) as f:
-                f.readline(); shape = eval(f.readline()[16:])
-                data[name][chain] = np.loadtxt(os.path.join(folder, file), delimiter=',').reshape(shape)
-                f.close()
-
-
-    # Create the Traces.
+        for name, file in zip(funnames, files):
+            if file.endswith('.npy'):
+                data[name][chain] = np.load(os.path.join(folder, file), mmap_mode='r' if mmap else None)
+            elif file.endswith('.npz'):
+                runs = np.load(os.path.join(folder, file))
+                data[name][chain] = np.repeat(runs['values'], runs['counts'], axis=0)
+                runs.close()
+            else:
+                ascii[name].append((chain, os.path.join(folder, file)))
+
+    # Keep the format of the last chain for the chains appended later.
+    exts = [os.path.splitext(f)[1] for f in files]
+    if binary is None:
+        binary = not exts or '.npy' in exts or '.npz' in exts
+    if compact is None:
+        compact = '.npz' in exts or any([_is_compact_txt(os.path.join(folder, f))
+                                         for f, e in zip(files, exts) if e == '.txt'])
+    db.binary = binary
+    db.compact = compact
+
+    # Parse the ASCII traces of each variable across all chains at once.
+    for name, entries in ascii.iteritems():
+        chains, paths = zip(*entries)
+        data[name].update(zip(chains, _loadtxt_chains(paths)))
+
+    # Create the Traces and expose them as attributes of the database.
     for name, values in data.iteritems():
         db._traces[name] = Trace(name=name, value=values, db=db)
-        setattr(db, name, db._traces[name])
+    db.__dict__.update(db._traces)
 
     # Load the state.
     statefile = os.path.join(dirname, 'state.txt')
@@ -167,16 +267,129 @@ def load(dirname):
 
     return db
 
-def funname(file):
-    """Return variable names from file names."""
-    if type(file) is str:
-        files = [file]
-    else:
-        files = file
-    bases = [os.path.basename(f) for f in files]
-    names = [os.path.splitext(b)[0] for b in bases]
-    if type(file) is str:
-        return names[0]
-    else:
+def _staterepr(obj):
+    """Return a string evaluating to obj, with NumPy arrays printed in full
+    and with enough digits to recover their exact values."""
+    if isinstance(obj, dict):
+        return '{%s}' % ', '.join(['%r: %s' % (k, _staterepr(v)) for k, v in obj.iteritems()])
+    if isinstance(obj, list):
+        return '[%s]' % ', '.join([_staterepr(v) for v in obj])
+    if isinstance(obj, tuple):
+        return '(%s)' % ''.join([_staterepr(v) + ', ' for v in obj])
+    if isinstance(obj, np.ndarray):
+        try:
+            values = np.array2string(obj, separator=',', threshold=sys.maxsize, floatmode='unique')
+        except TypeError:
+            # NumPy < 1.14 only takes these settings from the print options.
+            oldopts = np.get_printoptions()
+            np.set_printoptions(precision=17, threshold=sys.maxsize)
+            try:
+                values = np.array2string(obj, separator=',')
+            finally:
+                np.set_printoptions(**oldopts)
+        # The dtype string drops the field names of structured arrays.
+        if obj.dtype.fields:
+            dtype = obj.dtype.descr
+        else:
+            dtype = obj.dtype.str
+        return 'array(%s, dtype=%r)' % (values, dtype)
+    return repr(obj)
+
+def _is_compact_txt(path):
+    """Return whether the ASCII trace in `path` has a run length column."""
+    with open(path) as f:
+        for line in f:
+            if not line.startswith('#'):
+                return False
+            if line.startswith(RUNS_HEADER):
+                return True
+    return False
+
+def _listdir(path, dirs=False):
+    """Return the names of the files in directory `path`, or of its
+    subdirectories if `dirs` is True.
+
+    `scandir` is used when available (Python 3.5, or the scandir package) so
+    the entry types come from the directory listing instead of one stat call
+    per entry.
+    """
+    if scandir is None:
+        names = os.listdir(path)
+        if dirs:
+            names = [n for n in names if os.path.isdir(os.path.join(path, n))]
         return names
+    entries = scandir(path)
+    try:
+        return [e.name for e in entries if e.is_dir() == dirs]
+    finally:
+        # Python 3.6 warns about iterators left open; older ones cannot be
+        # closed.
+        if hasattr(entries, 'close'):
+            entries.close()
+
+def _runs(arr):
+    """Return the first sample of each run of identical consecutive samples
+    in arr, and the length of each run."""
+    n = len(arr)
+    flat = arr.reshape((n, int(np.prod(arr.shape[1:]))))
+    new = np.ones(n, dtype=bool)
+    new[1:] = (flat[1:] != flat[:-1]).any(axis=1)
+    starts = np.flatnonzero(new)
+    return arr[starts], np.diff(np.append(starts, n))
+
+def _loadtxt_chains(paths):
+    """Return the list of traces stored in the ASCII files `paths`.
+
+    If all traces share the same shape and none is compact, the files are
+    concatenated and parsed in a single pass, then split along the first
+    axis.
+    """
+    shapes = []
+    bodies = []
+    compact = []
+    for path in paths:
+        with open(path) as f:
+            bodies.append(f.read())
+        # The header lines are left in the body and skipped as comments.
+        m = _SHAPE_RE.search(bodies[-1])
+        shapes.append(tuple(ast.literal_eval('(' + m.group(1) + ')')))
+        compact.append(bodies[-1].startswith(RUNS_HEADER, m.end() + 1))
+
+    if len(set(shapes)) == 1 and not any(compact):
+        arr = _readtxt(''.join(bodies))
+        return list(arr.reshape((len(paths),) + shapes[0]))
+
+    traces = []
+    for b, s, c in zip(bodies, shapes, compact):
+        if c:
+            runs = _readtxt(b).reshape((-1, 1 + int(np.prod(s[1:]))))
+            traces.append(np.repeat(runs[:, 1:], runs[:, 0].astype(int), axis=0).reshape(s))
+        else:
+            traces.append(_readtxt(b).reshape(s))
+    return traces
 
+def _readtxt(text):
+    """Return the comma-separated values in string `text` as an array.
+
+    Header lines are skipped as comments. Texts shorter than
+    SMALL_TXT_SIZE are parsed directly by `fromstring`, skipping the setup
+    cost of `read_csv` and `loadtxt`; the result is then flat. Larger texts
+    use `read_csv`'s default float parser, which is faster than its
+    round-trip one but may be off by one ulp from the written value.
+    """
+    if len(text) < SMALL_TXT_SIZE:
+        lines = [l for l in text.splitlines() if l and not l.startswith('#')]
+        return np.fromstring(','.join(lines), sep=',')
+    # pandas is imported here rather than with the module, so that importing
+    # pymc does not pay for it.
+    try:
+        import pandas as pd
+    except ImportError:
+        return np.loadtxt(StringIO(text), delimiter=',')
+    return pd.read_csv(StringIO(text), header=None, comment='#', dtype=np.float64, engine='c').values
+
+def funname(file):
+    """Return variable names from file names."""
+    if isinstance(file, basestring):
+        return os.path.splitext(os.path.basename(file))[0]
+    return [os.path.splitext(os.path.basename(f))[0] for f in file]
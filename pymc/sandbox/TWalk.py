@@ -16,6 +16,82 @@ from pymc.decorators import prop
 from copy import copy
 import pdb, warnings, sys
 
+try:
+    from numba import njit
+except ImportError:
+    njit = None
+
+def _jit(f):
+    """Compile f with numba if it is installed, otherwise return it unchanged.
+
+    NumPy's error model is used so that divisions by zero give inf or nan
+    as they do in the uncompiled functions.
+    """
+    if njit is None:
+        return f
+    return njit(cache=True, error_model='numpy')(f)
+
+# Proposal kernels. Each takes the pivot point x, the other point xp and the
+# mask phi of the coordinates to move, and returns the proposed value and
+# the Hastings factor of the move. Degenerate blow and hop moves, where x and
+# xp coincide on the selected coordinates, get a Hastings factor of -inf so
+# that they are rejected.
+
+@_jit
+def _walk_kernel(x, xp, phi, theta, u):
+    """Walk move, given the uniform variates u"""
+    z = (theta / (1 + theta))*(theta*u**2 + 2*u - 1)
+    return x + phi*(x - xp)*z, 0.0
+
+@_jit
+def _traverse_kernel(x, xp, phi, beta, nphi):
+    """Traverse move, given the scale beta"""
+    return np.where(phi, xp + beta*(xp - x), x), (nphi - 2)*np.log(beta)
+
+@_jit
+def _g(h, xp, s, nphi):
+    """Density function for blow and hop moves"""
+    return (nphi/2.0)*np.log(2*np.pi) + nphi*np.log(s) + 0.5*np.sum((h - xp)**2)/(s**2)
+
+if njit is None:
+    def _spread(x, xp, phi):
+        """Largest distance between x and xp over the coordinates selected by phi"""
+        d = np.abs(xp - x)[phi]
+        return d.max() if d.size else 0.0
+else:
+    @_jit
+    def _spread(x, xp, phi):
+        """Largest distance between x and xp over the coordinates selected by phi"""
+        s = 0.0
+        for i in range(x.size):
+            if phi[i]:
+                s = max(s, abs(xp[i] - x[i]))
+        return s
+
+@_jit
+def _blow_kernel(x, xp, phi, z, nphi):
+    """Blow move, given the standard normal variate z"""
+    sigma = _spread(x, xp, phi)
+    if sigma == 0.0:
+        return x.copy(), -np.inf
+    y = x + phi*sigma*z
+    return y, _g(y, xp, sigma, nphi) - _g(x, xp, sigma, nphi)
+
+@_jit
+def _hop_kernel(x, xp, phi, z, nphi):
+    """Hop move, given the standard normal variate z"""
+    sigma = _spread(x, xp, phi)/3.0
+    if sigma == 0.0:
+        return x.copy(), -np.inf
+    y = np.where(phi, xp + sigma*z, x)
+    return y, _g(y, xp, sigma, nphi) - _g(x, xp, sigma, nphi)
+
+# Number of scalar uniform variates drawn at once by TWalk
+_BUFSIZE = 1024
+
+# Maximum size in bytes of TWalk's buffer of per-element uniform variates
+_ROWBUF_BYTES = 1<<20
+
 class TWalk(StepMethod):
     """
     The t-walk is a scale-independent, adaptive MCMC algorithm for arbitrary
@@ -55,9 +131,6 @@ class TWalk(StepMethod):
         # Initialize superclass
         StepMethod.__init__(self, [stochastic], verbose=verbose, tally=tally)
         
-        # Ordered list of proposal kernels
-        self.kernels = [self.walk, self.traverse, self.blow, self.hop]
-        
         # Kernel for current iteration
         self.current_kernel = None
         
@@ -83,6 +156,15 @@ class TWalk(StepMethod):
         else:
             self._len = 1
         
+        # Ordered list of proposal kernels
+        if self._len == 1:
+            # The single element is always moved, so use the kernels that
+            # skip the selection mask.
+            self.kernels = [self._walk_scalar, self._traverse_scalar, self._blow_scalar, self._hop_scalar]
+            self.propose = self._propose_scalar
+        else:
+            self.kernels = [self.walk, self.traverse, self.blow, self.hop]
+        
         # Create attribute for holding value and secondary value
         self.values = [self.stochastic.value]
         
@@ -94,6 +176,19 @@ class TWalk(StepMethod):
         else:
             self.values.append(inits)
         
+        # Buffers of uniform variates, filled on first use and refilled once
+        # used up, so that seeding numpy.random after construction is
+        # honoured. Variates left in the buffers are still used after a later
+        # re-seed. The scalar kernels do not use the per-element rows.
+        if self._len == 1:
+            self._nrows = 0
+        else:
+            self._nrows = min(_BUFSIZE, max(1, _ROWBUF_BYTES // (8*self._len)))
+        self._rows = None
+        self._row_index = self._nrows
+        self._draws = None
+        self._draw_index = _BUFSIZE
+        
         # Flag for using second point in log-likelihood calculations
         self._prime = False
         
@@ -129,6 +224,37 @@ class TWalk(StepMethod):
             return 1
         return 0
     
+    def _random(self):
+        """Return a uniform variate from the buffer"""
+        
+        i = self._draw_index
+        if i == _BUFSIZE:
+            self._draws = random(_BUFSIZE).tolist()
+            i = 0
+        self._draw_index = i + 1
+        return self._draws[i]
+    
+    def _random_row(self):
+        """Return an array of uniform variates, one per element of the
+        stochastic, from the buffer"""
+        
+        i = self._row_index
+        if i == self._nrows:
+            self._rows = random((self._nrows, self._len))
+            i = 0
+        self._row_index = i + 1
+        return self._rows[i]
+    
+    def _points(self):
+        """Return the pivot point and the other point as float arrays"""
+        
+        if self._prime:
+            xp, x = self.values
+        else:
+            x, xp = self.values
+        
+        return np.atleast_1d(np.asarray(x, dtype=float)), np.atleast_1d(np.asarray(xp, dtype=float))
+    
     def walk(self):
         """Walk proposal kernel"""
         
@@ -138,28 +264,19 @@ class TWalk(StepMethod):
         # Mask for values to move
         phi = self.phi
         
-        theta = self.walk_theta
+        u = self._random_row()
         
-        u = random(len(phi))
-        z = (theta / (1 + theta))*(theta*u**2 + 2*u - 1)
-
-        if self._prime:
-            xp, x = self.values
-        else:
-            x, xp = self.values
+        x, xp = self._points()
             
         if self.verbose>1:
             print '\t' + 'Current value = ' + str(x)
         
-        x = x + phi*(x - xp)*z
+        x, self.hastings_factor = _walk_kernel(x, xp, phi, self.walk_theta, u)
         
         if self.verbose>1:
             print '\t' + 'Proposed value = ' + str(x)
         
         self.stochastic.value = x
-        
-        # Set proposal adjustment factor
-        self.hastings_factor = 0.0
     
     def traverse(self):
         """Traverse proposal kernel"""
@@ -167,34 +284,29 @@ class TWalk(StepMethod):
         if self.verbose>1:
             print '\t' + self._id + ' Running Traverse proposal kernel'
         
-        # Mask for values to move
-        phi = self.phi
-        
-        theta = self.traverse_theta
-        
-        # Calculate beta
-        if (random() < (theta-1)/(2*theta)):
-            beta = exp(1/(theta + 1)*log(random()))
-        else:
-            beta = exp(1/(1 - theta)*log(random()))
+        beta = self._beta()
         
-        if self._prime:
-            xp, x = self.values
-        else:
-            x, xp = self.values
+        x, xp = self._points()
             
         if self.verbose>1:
             print '\t' + 'Current value = ' + str(x)
         
-        x = (xp + beta*(xp - x))*phi + x*(phi==False)
+        x, self.hastings_factor = _traverse_kernel(x, xp, self.phi, beta, self._nphi)
         
         if self.verbose>1:
             print '\t' + 'Proposed value = ' + str(x)
         
         self.stochastic.value = x
     
-        # Set proposal adjustment factor
-        self.hastings_factor = (sum(phi) - 2)*log(beta)
+    def _beta(self):
+        """Draw the scale of the traverse move"""
+        
+        theta = self.traverse_theta
+        
+        if (self._random() < (theta-1)/(2*theta)):
+            return exp(1/(theta + 1)*log(self._random()))
+        else:
+            return exp(1/(1 - theta)*log(self._random()))
     
     def blow(self):
         """Blow proposal kernel"""
@@ -202,35 +314,17 @@ class TWalk(StepMethod):
         if self.verbose>1:
             print '\t' + self._id + ' Running Blow proposal kernel'
         
-        # Mask for values to move
-        phi = self.phi
-        
-        if self._prime:
-            xp, x = self.values
-        else:
-            x, xp = self.values
+        x, xp = self._points()
             
         if self.verbose>1:
             print '\t' + 'Current value ' + str(x)
         
-        sigma = max(phi*abs(xp - x))
-
-        x = x + phi*sigma*rnormal()
+        x, self.hastings_factor = _blow_kernel(x, xp, self.phi, rnormal(), self._nphi)
         
         if self.verbose>1:
             print '\t' + 'Proposed value = ' + str(x)
         
-        self.hastings_factor = self._g(x, xp, sigma) - self._g(self.stochastic.value, xp, sigma)
-
         self.stochastic.value = x
-
-    def _g(self, h, xp, s):
-        """Density function for blow and hop moves"""
-        
-        nphi = sum(self.phi)
-        
-        return (nphi/2.0)*log(2*pi) + nphi*log(s) + 0.5*sum((h - xp)**2)/(s**2)
-    
     
     def hop(self):
         """Hop proposal kernel"""
@@ -238,29 +332,75 @@ class TWalk(StepMethod):
         if self.verbose>1:
             print '\t' + self._id + ' Running Hop proposal kernel'
         
-        # Mask for values to move
-        phi = self.phi
-        
-        if self._prime:
-            xp, x = self.values
-        else:
-            x, xp = self.values
+        x, xp = self._points()
     
         if self.verbose>1:
             print '\t' + 'Current value of x = ' + str(x)
         
-        sigma = max(phi*abs(xp - x))/3.0
-
-        x = (xp + sigma*rnormal())*phi + x*(phi==False)
+        x, self.hastings_factor = _hop_kernel(x, xp, self.phi, rnormal(), self._nphi)
         
         if self.verbose>1:
             print '\t' + 'Proposed value = ' + str(x)
         
-        self.hastings_factor = self._g(x, xp, sigma) - self._g(self.stochastic.value, xp, sigma)
-        
         self.stochastic.value = x
 
     
+    def _scalar_points(self):
+        """Return the pivot point and the other point of a scalar stochastic"""
+        
+        if self._prime:
+            return self.values[1], self.values[0]
+        return self.values
+    
+    def _walk_scalar(self):
+        """Walk proposal kernel for scalar stochastics"""
+        
+        x, xp = self._scalar_points()
+        theta = self.walk_theta
+        u = self._random()
+        z = (theta / (1 + theta))*(theta*u**2 + 2*u - 1)
+        
+        self.stochastic.value = x + (x - xp)*z
+        self.hastings_factor = 0.0
+    
+    def _traverse_scalar(self):
+        """Traverse proposal kernel for scalar stochastics"""
+        
+        x, xp = self._scalar_points()
+        beta = self._beta()
+        
+        self.stochastic.value = xp + beta*(xp - x)
+        self.hastings_factor = -log(beta)
+    
+    def _blow_scalar(self):
+        """Blow proposal kernel for scalar stochastics"""
+        
+        x, xp = self._scalar_points()
+        sigma = abs(xp - x)
+        y = x + sigma*rnormal()
+        
+        self.stochastic.value = y
+        self.hastings_factor = self._scalar_hastings(x, xp, y, sigma)
+    
+    def _hop_scalar(self):
+        """Hop proposal kernel for scalar stochastics"""
+        
+        x, xp = self._scalar_points()
+        sigma = abs(xp - x)/3.0
+        y = xp + sigma*rnormal()
+        
+        self.stochastic.value = y
+        self.hastings_factor = self._scalar_hastings(x, xp, y, sigma)
+    
+    def _scalar_hastings(self, x, xp, y, sigma):
+        """Hastings factor of the scalar blow and hop moves"""
+        
+        if sigma == 0:
+            # Degenerate move, rejected as in _blow_kernel and _hop_kernel
+            return -np.inf
+        # The normalizing terms of _g cancel out
+        return float(0.5*((y - xp)**2 - (x - xp)**2)/sigma**2)
+    
     def reject(self):
         """Sets current s value to the last accepted value"""
         self.stochastic.revert()
@@ -275,37 +415,58 @@ class TWalk(StepMethod):
         """This method is called by step() to generate proposed values"""
         
         # Generate uniform variate to choose kernel
-        self.current_kernel = sum(self.cum_probs < random())
+        self.current_kernel = int(np.searchsorted(self.cum_probs, self._random()))
         kernel = self.kernels[self.current_kernel]
         
         # Parameters to move
-        self.phi = (random(self._len) < self.p)
+        self.phi = (self._random_row() < self.p)
+        self._nphi = int(self.phi.sum())
+        
+        if not self._nphi:
+            # Nothing to move. Set the current value again so that reject()
+            # reverts to it.
+            self.stochastic.value = self.stochastic.value
+            raise ZeroProbability
 
         # Propose new value
         kernel()
 
+    def _propose_scalar(self):
+        """propose() for scalar stochastics, whose only element always moves"""
+        
+        # Generate uniform variate to choose kernel
+        self.current_kernel = int(np.searchsorted(self.cum_probs, self._random()))
+        self.kernels[self.current_kernel]()
+        
+        if self.verbose>1:
+            print '\t' + self._id + ' proposed value = ' + str(self.stochastic.value)
     
     def step(self):
         """Single iteration of t-walk algorithm"""
                 
         valid_proposal = False
         
+        # Local references for the attributes used throughout the step
+        stoch = self.stochastic
+        values = self.values
+        verbose = self.verbose
+        
         # Use x or xprime as pivot
-        self._prime = (random() < 0.5)
+        self._prime = prime = (self._random() < 0.5)
         
-        if self.verbose>1:
-            print "\n\nUsing x%s as pivot" % (" prime"*self._prime or "")
+        if verbose>1:
+            print "\n\nUsing x%s as pivot" % (" prime"*prime or "")
         
-        if self._prime:
+        if prime:
             # Set the value of the stochastic to the auxiliary
-            self.stochastic.value = self.values[1]
+            stoch.value = values[1]
             
-            if self.verbose>1:
-                print self._id, "setting value to auxiliary", self.stochastic.value
+            if verbose>1:
+                print self._id, "setting value to auxiliary", stoch.value
         
         # Current log-probability
         logp = self.logp_plus_loglike
-        if self.verbose>1:
+        if verbose>1:
             print "Current logp", logp
         
         try:
@@ -313,44 +474,41 @@ class TWalk(StepMethod):
             while not valid_proposal:
                 self.propose()
                 # Check that proposed value lies in support
-                valid_proposal = self._support(self.stochastic.value)
-                
-            if not sum(self.phi):
-                raise ZeroProbability
+                valid_proposal = self._support(stoch.value)
 
             # Proposed log-probability
             logp_p = self.logp_plus_loglike
-            if self.verbose>1:
+            if verbose>1:
                 print "Proposed logp", logp_p
             
         except ZeroProbability:
             
             # Reject proposal
-            if self.verbose>1:
+            if verbose>1:
                 print self._id + ' rejecting due to ZeroProbability.'
             self.reject()
             
-            if self._prime:
+            if prime:
                 # Update value list
-                self.values[1] = self.stochastic.value
+                values[1] = stoch.value
                 # Revert to stochastic's value for next iteration
-                self.stochastic.value = self.values[0]
+                stoch.value = values[0]
             
-                if self.verbose>1:
-                    print self._id, "reverting stochastic to primary value", self.stochastic.value
+                if verbose>1:
+                    print self._id, "reverting stochastic to primary value", stoch.value
             else:
                 # Update value list
-                self.values[0] = self.stochastic.value
+                values[0] = stoch.value
 
-            if self.verbose>1:
+            if verbose>1:
                 print self._id + ' returning.'
             return
         
-        if self.verbose>1:
+        if verbose>1:
             print 'logp_p - logp: ', logp_p - logp
         
         # Evaluate acceptance ratio
-        if log(random()) > (logp_p - logp + self.hastings_factor):
+        if log(self._random()) > (logp_p - logp + self.hastings_factor):
             
             # Revert s if fail
             self.reject()
@@ -358,18 +516,18 @@ class TWalk(StepMethod):
         else:
             # Increment accepted count
             self.accepted[self.current_kernel] += 1
-            if self.verbose > 1:
+            if verbose > 1:
                 print self._id + ' accepting'
         
-        if self._prime:
+        if prime:
             # Update value list
-            self.values[1] = self.stochastic.value
+            values[1] = stoch.value
             # Revert to stochastic's value for next iteration
-            self.stochastic.value = self.values[0]
+            stoch.value = values[0]
             
-            if self.verbose>1:
-                print self._id, "reverting stochastic to primary value", self.stochastic.value
+            if verbose>1:
+                print self._id, "reverting stochastic to primary value", stoch.value
                 
         else:
             # Update value list
-            self.values[0] = self.stochastic.value
+            values[0] = stoch.value
@@ -160,6 +160,11 @@ class TestPickle(TestRam):
 
 class TestTxt(TestPickle):
     name = 'txt'
+    # Keyword arguments passed to the txt Database, and the extension of
+    # the trace files they produce.
+    db_kwds = {}
+    ext = '.npy'
+
     @classmethod
     def setUpClass(self):
 
@@ -171,6 +176,117 @@ class TestTxt(TestPickle):
     def load(self):
         return pymc.database.txt.load(os.path.join(testdir, 'Disaster.txt'))
 
+    def check_nd(self, db_kwds, ext):
+        dbname = os.path.join(testdir, 'ND%s.txt' % ''.join(sorted(db_kwds)))
+        M = MCMC([self.NDstoch()], db='txt', dbname=dbname, dbmode='w', **db_kwds)
+        M.sample(10)
+        a = M.trace('nd')[:]
+        assert_equal(a.shape, (10,2,2))
+        assert os.path.exists(os.path.join(dbname, 'Chain_0', 'nd'+ext))
+        db = pymc.database.txt.load(dbname)
+        assert_equal(db.trace('nd')[:], a)
+
+    def test_nd(self):
+        self.check_nd(self.db_kwds, self.ext)
+
+    def test_yconnect_and_sample(self):
+        TestPickle.test_yconnect_and_sample(self)
+        # The appended chain keeps the format of the database.
+        db = self.load()
+        for chain in db.get_chains():
+            assert os.path.exists(os.path.join(db._directory, chain, 'e'+self.ext))
+
+class TestTxtAscii(TestTxt):
+    db_kwds = {'binary':False}
+    ext = '.txt'
+
+    @classmethod
+    def setUpClass(self):
+
+        self.S = pymc.MCMC(DisasterModel,
+                           db='txt',
+                           dbname=os.path.join(testdir, 'Disaster.ascii.txt'),
+                           dbmode='w',
+                           binary=False)
+
+    def load(self):
+        return pymc.database.txt.load(os.path.join(testdir, 'Disaster.ascii.txt'))
+
+class TestTxtCompact(TestTxt):
+    db_kwds = {'compact':True}
+    ext = '.npz'
+
+    @classmethod
+    def setUpClass(self):
+
+        self.S = pymc.MCMC(DisasterModel,
+                           db='txt',
+                           dbname=os.path.join(testdir, 'Disaster.compact.txt'),
+                           dbmode='w',
+                           compact=True)
+
+    def load(self):
+        return pymc.database.txt.load(os.path.join(testdir, 'Disaster.compact.txt'))
+
+    def test_nd_ascii(self):
+        self.check_nd({'compact':True, 'binary':False}, '.txt')
+        path = os.path.join(testdir, 'NDbinarycompact.txt', 'Chain_0', 'nd.txt')
+        with open(path) as f:
+            assert pymc.database.txt.RUNS_HEADER in f.read()
+        db = pymc.database.txt.load(os.path.join(testdir, 'NDbinarycompact.txt'))
+        assert db.compact and not db.binary
+
+def test_txt_runs():
+    a = np.array([[1.,2.], [1.,2.], [3.,4.], [1.,2.], [1.,2.], [1.,2.]])
+    values, counts = pymc.database.txt._runs(a)
+    assert_equal(values, [[1.,2.], [3.,4.], [1.,2.]])
+    assert_equal(counts, [2, 1, 3])
+    assert_equal(np.repeat(values, counts, axis=0), a)
+
+def write_txt_chains(name, traces):
+    """Write each trace in ASCII as a txt database would, and return the
+    file paths."""
+    paths = []
+    for i, a in enumerate(traces):
+        path = os.path.join(testdir, '%s_%d.txt' % (name, i))
+        with open(path, 'w') as f:
+            f.write('# Variable: %s\n# Sample shape: %s\n# Date: x\n' % (name, str(a.shape)))
+            np.savetxt(f, a.reshape((len(a), -1)), fmt='%.17g', delimiter=',')
+        paths.append(path)
+    return paths
+
+def test_txt_loadtxt_chains():
+    # Equal shapes are parsed in a single pass, mixed ones one by one.
+    for lengths in [(5, 5, 5), (5, 3, 8)]:
+        traces = [np.random.random((n, 2, 3)) for n in lengths]
+        paths = write_txt_chains('chains', traces)
+        loaded = pymc.database.txt._loadtxt_chains(paths)
+        assert_equal(len(loaded), len(traces))
+        for a, b in zip(loaded, traces):
+            assert_equal(a.shape, b.shape)
+            assert_array_equal(a, b)
+
+def test_txt_staterepr():
+    rec = np.array([(1, .1), (2, 1/3.)], dtype=[('a', '<i8'), ('b', '<f8')])
+    big = np.arange(1000001) % 7
+    floats = np.array([.1 + .2, 1/3., np.nextafter(1., 2.), 1e-300])
+    state = {'sampler': {'_iter': 10, 'theta': .1 + .2, 'one': (1,),
+                         'nested': [np.array(1.5), (2, [3.], {'x': (np.array(2),)})]},
+             'rec': rec, 'big': big, 'floats': floats}
+    s = eval(pymc.database.txt._staterepr(state), {'array': np.array})
+    assert_equal(s['sampler']['_iter'], 10)
+    assert_equal(s['sampler']['theta'], .1 + .2)
+    assert_equal(s['sampler']['one'], (1,))
+    zerod, (two, three, d) = s['sampler']['nested']
+    assert_equal(zerod.shape, ())
+    assert_equal(zerod, 1.5)
+    assert_equal((two, three), (2, [3.]))
+    assert_equal(d['x'][0].shape, ())
+    assert_equal(s['rec'].dtype, rec.dtype)
+    assert_array_equal(s['rec'], rec)
+    assert_array_equal(s['big'], big)
+    assert_array_equal(s['floats'], floats)
+
 
 class TestSqlite(TestPickle):
     name = 'sqlite'
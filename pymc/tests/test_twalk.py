@@ -0,0 +1,90 @@
+"""Test the t-walk step method and its proposal kernels."""
+
+from numpy.testing import TestCase, assert_almost_equal, assert_array_almost_equal, assert_array_equal, assert_equal
+import pymc
+from pymc.sandbox import TWalk as twalk
+import numpy as np
+
+
+def plain(kernel):
+    """Return the uncompiled version of a (possibly numba-compiled) kernel."""
+    return getattr(kernel, 'py_func', kernel)
+
+
+class TestKernels(TestCase):
+    x = np.array([.3, .4, .5, .1])
+    xp = np.array([.35, .9, .55, .2])
+    phi = np.array([True, False, True, True])
+
+    def test_compiled_matches_plain(self):
+        u = np.random.random(4)
+        calls = [(twalk._walk_kernel, (self.x, self.xp, self.phi, 1.5, u)),
+                 (twalk._traverse_kernel, (self.x, self.xp, self.phi, .8, 3)),
+                 (twalk._blow_kernel, (self.x, self.xp, self.phi, .3, 3)),
+                 (twalk._hop_kernel, (self.x, self.xp, self.phi, .3, 3))]
+        for kernel, args in calls:
+            y, h = kernel(*args)
+            y_plain, h_plain = plain(kernel)(*args)
+            assert_array_almost_equal(y, y_plain)
+            assert_array_almost_equal(h, h_plain)
+
+    def test_degenerate_moves(self):
+        # No coordinate selected, or x and xp equal on the selected ones.
+        for phi, xp in [(np.zeros(4, dtype=bool), self.xp),
+                        (self.phi, np.where(self.phi, self.x, self.xp))]:
+            for kernel in (twalk._blow_kernel, twalk._hop_kernel):
+                y, h = kernel(self.x, xp, phi, .3, int(phi.sum()))
+                assert_array_equal(y, self.x)
+                assert_equal(h, -np.inf)
+
+
+class TestTWalk(TestCase):
+    def test_no_selected_coordinate_is_rejected(self):
+        x = pymc.Normal('x', mu=np.zeros(10), tau=1., value=np.ones(10))
+        sm = twalk.TWalk(x, inits=np.zeros(10))
+        sm.p = 0.
+        for i in range(10):
+            sm.step()
+        assert_equal(sm.rejected.sum(), 10)
+        assert_equal(sm.accepted.sum(), 0)
+        assert_array_equal(x.value, np.ones(10))
+        assert_array_equal(sm.values[1], np.zeros(10))
+
+    def use_kernel(self, sm, i):
+        """Make sm always choose kernel i."""
+        sm.cum_probs = np.array([0.]*i + [1.]*(4 - i))
+
+    def test_scalar_kernels(self):
+        s = pymc.Normal('s', mu=0., tau=1., value=1.)
+        sm = twalk.TWalk(s, inits=0.5)
+        for i in range(4):
+            self.use_kernel(sm, i)
+            for j in range(20):
+                sm.step()
+            assert_equal(sm.accepted[i] + sm.rejected[i], 20)
+            assert np.isfinite(s.value)
+        assert_equal(sm.accepted.sum() + sm.rejected.sum(), 80)
+
+    def test_scalar_hastings(self):
+        s = pymc.Normal('s', mu=0., tau=1., value=1.)
+        sm = twalk.TWalk(s, inits=0.5)
+        x, xp, y, sigma = .3, .8, -.2, .5
+        assert_almost_equal(sm._scalar_hastings(x, xp, y, sigma),
+                            plain(twalk._g)(y, xp, sigma, 1) - plain(twalk._g)(x, xp, sigma, 1))
+
+    def test_scalar_degenerate_moves(self):
+        # Blow and hop moves with x == xp are rejected.
+        s = pymc.Normal('s', mu=0., tau=1., value=1.)
+        sm = twalk.TWalk(s, inits=1.)
+        for i in (2, 3):
+            self.use_kernel(sm, i)
+            for j in range(10):
+                sm.step()
+            assert_equal(sm.rejected[i], 10)
+            assert_equal(sm.accepted[i], 0)
+            assert_equal(s.value, 1.)
+
+
+if __name__ == '__main__':
+    import unittest
+    unittest.main()